@@ -1,24 +1,79 @@
 import pandas as pd
+import openpyxl
 import time
 import imaplib
 import email
+import email.policy
 import re
+import ipaddress
+import base64
+import quopri
 import os
+import shutil
+import json
+import select
+import ssl
 import zipfile
+import multiprocessing.util
+import requests
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 
+# Precompiled patterns for OTP extraction
+# Single-pass OTP scan over all candidates; a prefixed code beats a bare 6-digit
+# run, which beats a bare 4-digit run, wherever they appear in the body. Prefixes
+# must start a word so "штрихкод", "promocode" or "unicode-range" don't count.
+# The gap after the prefix is a bounded run of non-digit characters to keep
+# backtracking linear on large HTML bodies. Every alternative must be a whole digit
+# run, so longer numbers (tracking IDs, timestamps) are never taken as codes.
+_OTP_COMBINED = re.compile(
+    r'(?P<kod>(?<!\w)код[^0-9]{0,40}(\d{4,8})(?!\d))'
+    r'|(?P<code>\bcode\b[^0-9]{0,40}(\d{4,8})(?!\d))'
+    r'|(?P<d6>(?<!\d)\d{6}(?!\d))'
+    r'|(?P<d4>(?<!\d)\d{4}(?!\d))',
+    re.IGNORECASE
+)
+# Stylesheets and scripts in HTML parts are full of numbers that are never the code
+_HTML_NOISE = re.compile(r'<(style|script)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+
+# lastgroup -> (priority, group holding the code, description)
+_OTP_KINDS = {
+    'kod': (0, 2, "OTP with 'код' prefix"),
+    'code': (0, 4, "OTP with 'code' prefix"),
+    'd6': (1, 'd6', "6-digit OTP"),
+    'd4': (2, 'd4', "4-digit OTP"),
+}
+
+# Tokens of an IMAP parenthesized list: parens, quoted strings and atoms
+_IMAP_TOKEN = re.compile(rb'\(|\)|"(?:\\.|[^"\\])*"|[^\s()"]+')
+
+# Origins whose storage is wiped between accounts sharing a browser
+_OZON_ORIGINS = ["https://www.ozon.ru", "https://ozon.ru"]
+
+# Each worker process keeps one browser alive across the accounts it handles
+_worker_browser = None
+
+# Spreadsheet columns the script actually reads
+_ACCOUNT_COLUMNS = ['Cookies', 'Телефон', 'Привязанная\nпочта', 'пароль от\nпочты']
+
+# Services that return the caller's public IP as plain text
+_IP_SERVICES = [
+    "https://api.ipify.org",
+    "https://ifconfig.me/ip",
+    "https://ipinfo.io/ip"
+]
+
 def create_proxy_auth_extension(proxy_host, proxy_port, proxy_username, proxy_password, scheme='http', plugin_path=None):
     """Create a Chrome extension to add proxy authentication"""
     if plugin_path is None:
-        plugin_path = f'proxy_auth_plugin_{time.time()}.zip'
+        plugin_path = 'proxy_auth_plugin.zip'
 
     manifest_json = """
     {
@@ -77,115 +132,379 @@ def create_proxy_auth_extension(proxy_host, proxy_port, proxy_username, proxy_pa
     
     return plugin_path
 
-def extract_otp_from_email(mail_server, email_address, email_password, max_retries=8, retry_interval=5):
-    """Extract OTP code from email with improved retries"""
-    print(f"Connecting to {mail_server} with {email_address}")
+def find_otp_in_text(body, html=False):
+    """Scan a message body once and return (otp, description) or (None, None)"""
+    if html:
+        body = _HTML_NOISE.sub(' ', body)
     
-    for attempt in range(max_retries):
-        try:
-            # Connect to mail server
-            mail = imaplib.IMAP4_SSL(mail_server)
-            mail.login(email_address, email_password)
-            mail.select("inbox")
-            
-            # Search for recent emails from Ozon
-            result, data = mail.search(None, '(FROM "ozon.ru" UNSEEN)')
-            mail_ids = data[0].split()
-            
-            if not mail_ids:
-                print(f"No new emails found, trying broader search (attempt {attempt+1}/{max_retries})...")
-                # Try a broader search
-                result, data = mail.search(None, '(FROM "ozon.ru")')
-                mail_ids = data[0].split()
+    best_priority, best = None, (None, None)
+    for otp_match in _OTP_COMBINED.finditer(body):
+        priority, group, description = _OTP_KINDS[otp_match.lastgroup]
+        if best_priority is None or priority < best_priority:
+            best_priority, best = priority, (otp_match.group(group), description)
+            if priority == 0:
+                # Nothing outranks a prefixed code
+                break
+    return best
+
+def has_buffered_input(mail):
+    """Check without blocking whether data is already buffered in the IMAP connection"""
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        # peek() returns the reader's buffer, or at most one non-blocking socket read
+        return bool(mail.file.peek(1))
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+def wait_for_new_mail(mail, timeout):
+    """Wait for new mail using IMAP IDLE, falling back to a plain sleep if unsupported"""
+    if 'IDLE' not in mail.capabilities:
+        time.sleep(timeout)
+        return False
+    
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    
+    # Untagged data (e.g. "* 5 EXISTS") may arrive before the continuation
+    new_mail = False
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while entering IDLE")
+        if line.startswith(b'+'):
+            break
+        if line.startswith(tag):
+            # Server answered NO/BAD to IDLE, poll the old way
+            if not new_mail:
+                time.sleep(timeout)
+            return new_mail
+        if b'EXISTS' in line or b'RECENT' in line:
+            new_mail = True
+    
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not has_buffered_input(mail):
+            readable, _, _ = select.select([mail.sock], [], [], remaining)
+            if not readable:
+                break
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if b'EXISTS' in line or b'RECENT' in line:
+            new_mail = True
+    
+    # Leave IDLE and consume the tagged completion response
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+        if line.startswith(tag):
+            break
+        if b'EXISTS' in line or b'RECENT' in line:
+            new_mail = True
+    
+    return new_mail
+
+def connect_mailbox(mail_server, email_address, email_password):
+    """Open an IMAP connection with the inbox selected"""
+    mail = imaplib.IMAP4_SSL(mail_server)
+    mail.login(email_address, email_password)
+    
+    # imaplib keeps the pre-login capabilities; many servers only advertise SORT/IDLE after auth
+    result, data = mail.capability()
+    if result == 'OK' and data and data[0]:
+        mail.capabilities = tuple(data[0].decode().upper().split())
+    
+    mail.select("inbox")
+    return mail
+
+def get_uid_next(mail):
+    """Return the UID the next message delivered to the selected mailbox will get, or None"""
+    # SELECT normally reports it as an untagged [UIDNEXT n] response code
+    result, data = mail.response('UIDNEXT')
+    if data and data[0]:
+        return int(data[0])
+    
+    result, data = mail.status('INBOX', '(UIDNEXT)')
+    uid_next = re.search(rb'UIDNEXT (\d+)', data[0] or b'') if result == 'OK' and data else None
+    return int(uid_next.group(1)) if uid_next else None
+
+def close_mailbox(mail):
+    """Close an IMAP connection, ignoring errors from an already broken one"""
+    try:
+        mail.close()
+        mail.logout()
+    except:
+        pass
+
+def imap_or(*keys):
+    """Combine search keys with IMAP's binary prefix OR"""
+    if len(keys) == 1:
+        return keys[0]
+    return f'OR {keys[0]} {imap_or(*keys[1:])}'
+
+def run_uid_command(mail, literal, command, *args):
+    """Run a UID command, reporting a BAD reply as a result instead of raising"""
+    mail.literal = literal
+    try:
+        return mail.uid(command, *args)
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error as e:
+        return 'BAD', [str(e).encode()]
+
+def search_uids_newest_first(mail, criteria, literal=None):
+    """Return UIDs matching the criteria, newest first, using server-side SORT when available.
+    
+    A non-ASCII value for the last search key can be passed as a UTF-8 literal.
+    """
+    if 'SORT' in mail.capabilities:
+        result, data = run_uid_command(mail, literal, 'SORT', '(REVERSE DATE)', 'UTF-8', criteria)
+        if result == 'OK':
+            return (data[0] or b'').split()
+        print(f"SORT failed ({result}: {data}), falling back to SEARCH")
+    
+    result, data = run_uid_command(mail, literal, 'SEARCH', 'CHARSET', 'UTF-8', criteria)
+    if result != 'OK':
+        print(f"SEARCH failed ({result}: {data})")
+        return []
+    return (data[0] or b'').split()[::-1]
+
+def fetch_headers(mail, uids, fields):
+    """Fetch the given header fields for several UIDs in one round trip, keyed by UID"""
+    result, data = mail.uid('FETCH', b','.join(uids), f'(BODY.PEEK[HEADER.FIELDS ({fields})])')
+    if result != 'OK':
+        return {}
+    
+    headers = {}
+    pending = None
+    for item in data:
+        # The UID may come before the header literal or in the text right after it
+        text = item[0] if isinstance(item, tuple) else item
+        uid_match = re.search(rb'UID (\d+)', text or b'')
+        if isinstance(item, tuple):
+            pending = email.message_from_bytes(item[1], policy=email.policy.default)
+            if uid_match:
+                headers[uid_match.group(1)] = pending
+                pending = None
+        elif pending is not None and uid_match:
+            headers[uid_match.group(1)] = pending
+            pending = None
+    return headers
+
+def is_ozon_sender(header):
+    """Check whether a message's From address belongs to an ozon.ru domain"""
+    try:
+        addresses = header['From'].addresses
+    except (AttributeError, TypeError, IndexError):
+        return False
+    return any(address.domain.lower() == 'ozon.ru' or address.domain.lower().endswith('.ozon.ru') for address in addresses)
+
+def pick_otp_message(mail, uids, max_checked=5):
+    """Return the newest UID that looks like an Ozon OTP mail, checking headers only.
+    
+    Mail sent from ozon.ru is preferred; subject-only matches are a fallback.
+    """
+    candidates = uids[:max_checked]
+    headers = fetch_headers(mail, candidates, 'FROM SUBJECT')
+    
+    from_ozon, subject_matches = [], []
+    for uid in candidates:
+        header = headers.get(uid)
+        if header is None:
+            continue
+        subject = str(header.get('Subject', '')).lower()
+        looks_like_otp = any(keyword in subject for keyword in ('код', 'code', 'вход', 'ozon'))
+        if is_ozon_sender(header):
+            if looks_like_otp:
+                return uid
+            from_ozon.append(uid)
+        elif looks_like_otp:
+            subject_matches.append(uid)
+    
+    if from_ozon:
+        return from_ozon[0]
+    if subject_matches:
+        return subject_matches[0]
+    
+    # Nothing matched, fall back to the newest message
+    return uids[0]
+
+def parse_imap_list(data):
+    """Parse an IMAP FETCH response into nested lists of strings (NIL becomes None)"""
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            # (text ending in a {n} literal marker, literal bytes)
+            tokens.extend(_IMAP_TOKEN.findall(item[0]))
+            tokens[-1] = item[1]
+        elif item:
+            tokens.extend(_IMAP_TOKEN.findall(item))
+    
+    root = []
+    stack = [root]
+    for token in tokens:
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            finished = stack.pop()
+            stack[-1].append(finished)
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode('utf-8', errors='replace'))
+        else:
+            value = token.decode('utf-8', errors='replace')
+            stack[-1].append(None if value.upper() == 'NIL' else value)
+    return root
+
+def fetch_body_structure(mail, uid):
+    """Fetch and parse the BODYSTRUCTURE of a message"""
+    result, data = mail.uid('FETCH', uid, '(BODYSTRUCTURE)')
+    wanted_uid = uid.decode() if isinstance(uid, bytes) else str(uid)
+    
+    # Unsolicited FETCH responses (e.g. FLAGS updates) may be mixed in, so look
+    # for the response carrying BODYSTRUCTURE for this UID
+    for items in parse_imap_list(data):
+        if not isinstance(items, list):
+            continue
+        fields = {
+            items[i].upper(): items[i + 1]
+            for i in range(0, len(items) - 1, 2)
+            if isinstance(items[i], str)
+        }
+        if 'BODYSTRUCTURE' in fields and fields.get('UID', wanted_uid) == wanted_uid:
+            return fields['BODYSTRUCTURE']
+    raise ValueError("BODYSTRUCTURE missing from server response")
+
+def find_text_parts(structure, section=''):
+    """List text/plain parts followed by text/html parts as (section, subtype, encoding, charset)"""
+    plain, html = [], []
+    
+    def walk(node, section):
+        if isinstance(node[0], list):
+            # Multipart: child parts come first, then the subtype and extension data
+            for number, child in enumerate(node, start=1):
+                if not isinstance(child, list):
+                    break
+                walk(child, f"{section}.{number}" if section else str(number))
+            return
+        
+        content_type, subtype = (node[0] or '').lower(), (node[1] or '').lower()
+        if content_type != 'text' or subtype not in ('plain', 'html'):
+            return
+        params = node[2] or []
+        params = {params[i].lower(): params[i + 1] for i in range(0, len(params) - 1, 2)}
+        part = (section or '1', subtype, (node[5] or '7BIT').upper(), params.get('charset') or 'utf-8')
+        (plain if subtype == 'plain' else html).append(part)
+    
+    walk(structure, section)
+    return plain + html
+
+def fetch_text_part(mail, uid, part):
+    """Download a single MIME part without marking the message read and decode it to text"""
+    section, subtype, encoding, charset = part
+    result, data = mail.uid('FETCH', uid, f'(BODY.PEEK[{section}])')
+    raw = b"".join(item[1] for item in data if isinstance(item, tuple))
+    
+    if encoding == 'BASE64':
+        raw = base64.b64decode(raw)
+    elif encoding == 'QUOTED-PRINTABLE':
+        raw = quopri.decodestring(raw)
+    
+    try:
+        return raw.decode(charset, errors='ignore')
+    except LookupError:
+        return raw.decode('utf-8', errors='ignore')
+
+def extract_otp_from_email(mail_server, email_address, email_password, max_retries=8, retry_interval=5, mail=None, min_uid=None):
+    """Extract OTP code from email with improved retries.
+    
+    An already open connection can be handed over via mail (it is closed when done),
+    and min_uid restricts the search to messages delivered after that UID was recorded.
+    """
+    print(f"Looking for OTP in {email_address} on {mail_server}")
+    
+    # Only consider messages from the last few minutes (IMAP SINCE has day granularity)
+    since_date = (datetime.utcnow() - timedelta(minutes=10)).strftime('%d-%b-%Y')
+    
+    # Sender and subject fallbacks in a single SEARCH round trip. The final SUBJECT
+    # value ("код") is sent as a UTF-8 literal, which IMAP only allows at the end
+    search_criteria = f'SINCE {since_date} ' + imap_or('FROM "ozon.ru"', 'SUBJECT "ozon"', 'SUBJECT "code"', 'SUBJECT')
+    if min_uid:
+        # Codes from earlier attempts stay unread (fetches use PEEK), so only look at new mail
+        search_criteria = f'UID {min_uid}:* ' + search_criteria
+    
+    # One connection is reused across retries and only re-opened if the server drops it
+    try:
+        for attempt in range(max_retries):
+            try:
+                if mail is None:
+                    mail = connect_mailbox(mail_server, email_address, email_password)
                 
-                if not mail_ids:
-                    print(f"No emails from ozon.ru found. Trying with subject search...")
-                    result, data = mail.search(None, '(SUBJECT "код" OR SUBJECT "code" OR SUBJECT "ozon")')
-                    mail_ids = data[0].split()
-            
-            if mail_ids:
-                latest_email_id = mail_ids[-1]
-                result, data = mail.fetch(latest_email_id, "(RFC822)")
-                raw_email = data[0][1]
-                email_message = email.message_from_bytes(raw_email)
+                # Search for recent emails from Ozon, newest first. UIDs stay valid
+                # across expunges, and read state is ignored since PEEK never sets it
+                mail_ids = search_uids_newest_first(mail, search_criteria, literal='код'.encode('utf-8'))
+                if min_uid:
+                    # "n:*" still matches the last message when every UID is below n
+                    mail_ids = [uid for uid in mail_ids if int(uid) >= min_uid]
                 
-                # Extract OTP from email body
-                for part in email_message.walk():
-                    if part.get_content_type() == "text/plain" or part.get_content_type() == "text/html":
+                if not mail_ids:
+                    print(f"No Ozon emails found (attempt {attempt+1}/{max_retries})")
+                else:
+                    latest_email_id = pick_otp_message(mail, mail_ids)
+                    # Extract OTP from the body; the plain-text alternative is small and
+                    # free of tracking IDs, so HTML is only scanned if it yields nothing
+                    for part in find_text_parts(fetch_body_structure(mail, latest_email_id)):
                         try:
-                            body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                            
-                            # Look for common OTP patterns
-                            # 6-digit code (most common)
-                            otp_match = re.search(r'(\d{6})', body)
-                            if otp_match:
-                                otp = otp_match.group(1)
-                                print(f"Found 6-digit OTP: {otp}")
-                                mail.close()
-                                mail.logout()
-                                return otp
-                            
-                            # 4-digit code
-                            otp_match = re.search(r'(\d{4})', body)
-                            if otp_match:
-                                otp = otp_match.group(1)
-                                print(f"Found 4-digit OTP: {otp}")
-                                mail.close()
-                                mail.logout()
-                                return otp
+                            body = fetch_text_part(mail, latest_email_id, part)
                             
-                            # Check for specifically formatted codes
-                            # Common pattern in security emails
-                            otp_match = re.search(r'код\D*(\d+)', body, re.IGNORECASE)
-                            if otp_match:
-                                otp = otp_match.group(1)
-                                print(f"Found OTP with 'код' prefix: {otp}")
-                                mail.close()
-                                mail.logout()
-                                return otp
-                                
-                            otp_match = re.search(r'code\D*(\d+)', body, re.IGNORECASE)
-                            if otp_match:
-                                otp = otp_match.group(1)
-                                print(f"Found OTP with 'code' prefix: {otp}")
-                                mail.close()
-                                mail.logout()
+                            # Look for common OTP patterns in a single scan
+                            otp, description = find_otp_in_text(body, html=part[1] == 'html')
+                            if otp:
+                                print(f"Found {description}: {otp}")
                                 return otp
                         except Exception as e:
                             print(f"Error parsing email content: {e}")
                             continue
-            
-            mail.close()
-            mail.logout()
-            
-            if attempt < max_retries - 1:
-                print(f"OTP not found in attempt {attempt+1}, waiting {retry_interval}s before retry...")
-                time.sleep(retry_interval)
-            
-        except Exception as e:
-            print(f"Error extracting OTP (attempt {attempt+1}): {e}")
-            if attempt < max_retries - 1:
-                print(f"Retrying in {retry_interval} seconds...")
-                time.sleep(retry_interval)
+                
+                if attempt < max_retries - 1:
+                    print(f"OTP not found in attempt {attempt+1}, waiting up to {retry_interval}s for new mail...")
+                    wait_for_new_mail(mail, retry_interval)
+                
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"Mail connection lost (attempt {attempt+1}): {e}")
+                if mail is not None:
+                    try:
+                        mail.shutdown()
+                    except:
+                        pass
+                    mail = None
+                if attempt < max_retries - 1:
+                    print(f"Reconnecting in {retry_interval} seconds...")
+                    time.sleep(retry_interval)
+            except Exception as e:
+                print(f"Error extracting OTP (attempt {attempt+1}): {e}")
+                if attempt < max_retries - 1:
+                    print(f"Retrying in {retry_interval} seconds...")
+                    time.sleep(retry_interval)
+    finally:
+        if mail is not None:
+            close_mailbox(mail)
     
     print("Failed to extract OTP after all retries")
     return None
 
-def setup_browser_with_proxy(proxy_host, proxy_port, proxy_username, proxy_password):
+def setup_browser_with_proxy(plugin_path):
     """Setup browser with reliable proxy configuration"""
     options = Options()
-    plugin_path = None
     
     try:
-        # Create a unique plugin path to avoid conflicts
-        plugin_path = create_proxy_auth_extension(
-            proxy_host=proxy_host,
-            proxy_port=proxy_port,
-            proxy_username=proxy_username,
-            proxy_password=proxy_password,
-            plugin_path=f'proxy_auth_plugin_{time.time()}.zip'
-        )
-        
         # Anti-detection settings
         options.add_argument("--disable-blink-features=AutomationControlled")
         options.add_experimental_option("excludeSwitches", ["enable-automation"])
@@ -199,13 +518,21 @@ def setup_browser_with_proxy(proxy_host, proxy_port, proxy_username, proxy_passw
         options.add_argument("--disable-dev-shm-usage")
         options.add_argument("--disable-gpu")
         options.add_argument("--window-size=1920,1080")
+        options.add_argument("--headless=new")
+        
+        # Skip images and notification prompts, and return from get() on DOMContentLoaded
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.default_content_setting_values.notifications": 2
+        })
+        options.page_load_strategy = 'eager'
         
         # Add the proxy extension
         options.add_extension(plugin_path)
         
-        # Initialize browser
-        service = Service(ChromeDriverManager().install())
-        browser = webdriver.Chrome(service=service, options=options)
+        # Initialize browser; Selenium Manager resolves chromedriver from its local cache
+        browser = webdriver.Chrome(options=options)
         
         # Apply anti-fingerprinting script
         browser.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
@@ -222,33 +549,63 @@ def setup_browser_with_proxy(proxy_host, proxy_port, proxy_username, proxy_passw
         # Wait for proxy to initialize
         time.sleep(3)
         
-        return browser, plugin_path
+        return browser
         
     except Exception as e:
         print(f"Error setting up browser: {e}")
-        if plugin_path and os.path.exists(plugin_path):
+        return None
+
+def is_valid_ipv4(ip):
+    """Check that a string is a well-formed IPv4 address (each octet 0-255)"""
+    try:
+        ipaddress.IPv4Address(ip)
+        return True
+    except ValueError:
+        return False
+
+def check_proxy_ip(proxy_host, proxy_port, proxy_username, proxy_password, timeout=5):
+    """Query all IP services through the proxy in parallel and return the first valid IP"""
+    proxy_url = f"http://{proxy_username}:{proxy_password}@{proxy_host}:{proxy_port}"
+    proxies = {"http": proxy_url, "https": proxy_url}
+    
+    def fetch_ip(service):
+        response = requests.get(service, proxies=proxies, timeout=timeout)
+        response.raise_for_status()
+        return response.text.strip()
+    
+    executor = ThreadPoolExecutor(max_workers=len(_IP_SERVICES))
+    try:
+        futures = {executor.submit(fetch_ip, service): service for service in _IP_SERVICES}
+        for future in as_completed(futures):
             try:
-                os.remove(plugin_path)
-            except:
-                pass
-        return None, plugin_path
+                ip = future.result()
+            except Exception as e:
+                print(f"IP check via {futures[future]} failed: {e}")
+                continue
+            
+            if is_valid_ipv4(ip):
+                return ip
+            print(f"Invalid IP format from {futures[future]}: {ip}")
+    finally:
+        # Don't wait for the slower services once one has answered
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    return None
 
 def verify_proxy_working(browser):
     """Verify that the proxy is properly configured by checking IP"""
     try:
         # Try several IP checking services
-        ip_services = [
-            "https://api.ipify.org",
-            "https://ifconfig.me/ip",
-            "https://ipinfo.io/ip"
-        ]
-        
-        for service in ip_services:
+        for service in _IP_SERVICES:
             browser.get(service)
-            time.sleep(5)
-            ip = browser.find_element(By.TAG_NAME, "body").text.strip()
+            try:
+                ip = WebDriverWait(browser, 10).until(
+                    lambda d: d.find_element(By.TAG_NAME, "body").text.strip()
+                )
+            except TimeoutException:
+                ip = ""
             
-            if ip and re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", ip):
+            if is_valid_ipv4(ip):
                 print(f"Current IP: {ip}")
                 # Check if IP matches expected proxy IP or at least is different from a known non-proxy IP
                 if "85.142" in ip:
@@ -262,7 +619,10 @@ def verify_proxy_working(browser):
         
         # If we get here and haven't returned True, we should at least check that we can access a website
         browser.get("https://www.ozon.ru")
-        time.sleep(5)
+        try:
+            WebDriverWait(browser, 10).until(lambda d: "ozon" in d.current_url.lower())
+        except TimeoutException:
+            pass
         
         if "ozon" in browser.current_url.lower():
             print("Proxy appears to be working - can access Ozon")
@@ -274,57 +634,68 @@ def verify_proxy_working(browser):
         print(f"Error verifying proxy: {e}")
         return False
 
-def login_to_ozon(browser, phone_number, email_address, email_password, index, df):
-    """Handle the entire Ozon login process"""
+def login_to_ozon(browser, phone_number, email_address, email_password, index):
+    """Handle the entire Ozon login process and return the session cookies on success"""
     try:
-        # Navigate to Ozon
+        # Navigate to Ozon and wait until the login button is rendered
+        login_button_xpath = "//button[contains(., 'Войти') or contains(., 'Sign in')]"
         print("Navigating to Ozon.ru...")
         browser.get("https://www.ozon.ru")
-        time.sleep(10)
+        try:
+            WebDriverWait(browser, 15).until(EC.presence_of_element_located((By.XPATH, login_button_xpath)))
+        except TimeoutException:
+            pass
         
         # Check if we reached Ozon
         if "ozon" not in browser.current_url.lower():
             print(f"Failed to reach Ozon.ru, current URL is: {browser.current_url}")
             # Try again
             browser.get("https://www.ozon.ru")
-            time.sleep(10)
+            try:
+                WebDriverWait(browser, 15).until(EC.presence_of_element_located((By.XPATH, login_button_xpath)))
+            except TimeoutException:
+                pass
             
             if "ozon" not in browser.current_url.lower():
                 print("Failed to reach Ozon after multiple attempts")
                 browser.save_screenshot(f"error_navigation_{index}.png")
-                return False
+                return None
         
         print("Successfully reached Ozon.ru")
         
         # Click login button
         try:
             login_button = WebDriverWait(browser, 15).until(
-                EC.element_to_be_clickable((By.XPATH, "//button[contains(., 'Войти') or contains(., 'Sign in')]"))
+                EC.element_to_be_clickable((By.XPATH, login_button_xpath))
             )
             login_button.click()
             print("Clicked login button")
-            time.sleep(5)
         except Exception as e:
             print(f"Login button not found or couldn't click it: {e}")
             # We might already be on the login page, so continue
         
         # Enter phone number
         print("Looking for phone input field...")
+        mail = None
         try:
             phone_input = WebDriverWait(browser, 15).until(
                 EC.presence_of_element_located((By.XPATH, "//input[@type='tel' or contains(@placeholder, '999')]"))
             )
             phone_input.clear()
             
-            # Format phone number if needed
-            formatted_phone = phone_number
-            if not formatted_phone.startswith('+'):
-                if formatted_phone.startswith('9') or formatted_phone.startswith('8'):
-                    formatted_phone = '+7' + formatted_phone[-10:]
+            # Open the mailbox before the OTP is requested and remember where new mail
+            # starts, so only the code sent for this attempt is accepted
+            print(f"Opening mailbox {email_address}...")
+            try:
+                mail = connect_mailbox("imap.rambler.ru", email_address, email_password)
+                min_uid = get_uid_next(mail)
+            except Exception as e:
+                print(f"Failed to open mailbox, not requesting an OTP: {e}")
+                return None
             
-            print(f"Entering phone number: {formatted_phone}")
-            phone_input.send_keys(formatted_phone)
-            time.sleep(2)
+            # The phone number arrives already normalized by main()
+            print(f"Entering phone number: {phone_number}")
+            phone_input.send_keys(phone_number)
             
             # Click continue button or press Enter
             try:
@@ -337,7 +708,12 @@ def login_to_ozon(browser, phone_number, email_address, email_password, index, d
                 phone_input.send_keys(Keys.RETURN)
             
             print("Submitted phone number")
-            time.sleep(5)
+            
+            # The OTP locator also matches the phone field, so wait for that to go away first
+            try:
+                WebDriverWait(browser, 10).until(EC.staleness_of(phone_input))
+            except TimeoutException:
+                pass
             
             # Wait for OTP field
             print("Waiting for OTP field to appear...")
@@ -348,21 +724,25 @@ def login_to_ozon(browser, phone_number, email_address, email_password, index, d
             
             # Get OTP from email
             print("Retrieving OTP from email...")
-            otp_code = extract_otp_from_email("imap.rambler.ru", email_address, email_password)
+            otp_code = extract_otp_from_email(
+                "imap.rambler.ru", email_address, email_password, mail=mail, min_uid=min_uid
+            )
+            # extract_otp_from_email owns and closes the connection from here on
+            mail = None
             
             if not otp_code:
                 print("Failed to retrieve OTP")
                 browser.save_screenshot(f"error_otp_retrieval_{index}.png")
-                return False
+                return None
             
             print(f"OTP retrieved: {otp_code}")
             
             # Enter OTP
             otp_input.clear()
             otp_input.send_keys(otp_code)
-            time.sleep(2)
             
             # Submit OTP
+            url_before_confirm = browser.current_url
             try:
                 confirm_button = WebDriverWait(browser, 10).until(
                     EC.element_to_be_clickable((By.XPATH, "//button[@type='submit' or contains(., 'Войти') or contains(., 'Подтвердить') or contains(., 'Confirm') or contains(., 'Sign in')]"))
@@ -373,53 +753,146 @@ def login_to_ozon(browser, phone_number, email_address, email_password, index, d
                 print("No confirmation button found, pressing Enter")
                 otp_input.send_keys(Keys.RETURN)
             
-            # Wait for login to complete
+            # Wait for login to complete by looking for profile elements
             print("Waiting for login to complete...")
-            time.sleep(15)
-            
-            # Check if login successful by looking for profile elements
             success_indicators = [
                 "//div[contains(@class, 'profile') or contains(@class, 'account')]",
                 "//button[contains(., 'Профиль') or contains(., 'Profile')]",
                 "//a[contains(@href, 'profile') or contains(@href, 'account')]"
             ]
             
+            # The indicators can already match the login page, so first wait for the
+            # OTP form to go away or the page to navigate once the session is set
+            try:
+                WebDriverWait(browser, 20).until(
+                    EC.any_of(EC.staleness_of(otp_input), EC.url_changes(url_before_confirm))
+                )
+                otp_accepted = True
+            except TimeoutException:
+                otp_accepted = False
+            
             login_successful = False
-            for indicator in success_indicators:
+            if otp_accepted:
                 try:
-                    WebDriverWait(browser, 5).until(
-                        EC.presence_of_element_located((By.XPATH, indicator))
+                    WebDriverWait(browser, 10).until(
+                        EC.any_of(*[EC.presence_of_element_located((By.XPATH, x)) for x in success_indicators])
                     )
                     login_successful = True
-                    break
-                except:
+                except TimeoutException:
                     pass
             
-            if login_successful or "ozon.ru" in browser.current_url.lower():
+            if otp_accepted and (login_successful or "ozon.ru" in browser.current_url.lower()):
                 print("Login successful!")
                 
-                # Save cookies
-                cookies = browser.get_cookies()
-                df.at[index, 'Cookies'] = str(cookies)
-                print(f"Saved cookies for account {index+1}")
-                
-                # Save after each successful login
-                df.to_excel("acc_ozon_updated.xlsx", index=False)
-                return True
+                # Hand cookies back to the caller, which owns the spreadsheet
+                return browser.get_cookies()
             else:
                 print("Login appears to have failed")
                 browser.save_screenshot(f"login_failed_{index}.png")
-                return False
+                return None
                 
         except Exception as e:
             print(f"Error during phone/OTP process: {e}")
             browser.save_screenshot(f"error_login_process_{index}.png")
-            return False
+            return None
+        finally:
+            if mail is not None:
+                close_mailbox(mail)
             
     except Exception as e:
         print(f"Error in login_to_ozon function: {e}")
         browser.save_screenshot(f"error_general_{index}.png")
-        return False
+        return None
+
+def init_worker():
+    """Make sure a worker's browser is closed when the worker process exits"""
+    multiprocessing.util.Finalize(None, quit_worker_browser, exitpriority=10)
+
+def get_worker_browser(plugin_path):
+    """Return this worker's browser, starting a new one if there is none or it stopped responding"""
+    global _worker_browser
+    if _worker_browser is not None:
+        try:
+            _worker_browser.current_url
+            return _worker_browser
+        except Exception:
+            print("Browser stopped responding, starting a new one")
+            quit_worker_browser()
+    
+    _worker_browser = setup_browser_with_proxy(plugin_path)
+    return _worker_browser
+
+def quit_worker_browser():
+    """Close this worker's browser, if any"""
+    global _worker_browser
+    if _worker_browser is not None:
+        try:
+            _worker_browser.quit()
+        except:
+            pass
+        _worker_browser = None
+
+def reset_browser_identity(browser):
+    """Drop all cookies and Ozon site storage so the next account starts with a clean session"""
+    browser.get("about:blank")
+    browser.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    for origin in _OZON_ORIGINS:
+        browser.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+
+def process_account(index, account, plugin_path, proxy_verified=False):
+    """Log into a single account with the worker's browser and return (index, cookies)"""
+    print(f"\n{'='*50}")
+    print(f"Processing account {index+1}")
+    print(f"{'='*50}")
+    
+    browser = get_worker_browser(plugin_path)
+    if not browser:
+        print(f"Failed to initialize browser for account {index+1}. Skipping.")
+        return index, None
+    
+    try:
+        # The browser may have been used for a previous account
+        reset_browser_identity(browser)
+        
+        # Verify proxy is working, unless the pre-check in main() already did
+        if not proxy_verified and not verify_proxy_working(browser):
+            print(f"Proxy verification failed for account {index+1}. Skipping.")
+            return index, None
+        
+        # Get account details
+        phone_number = account['_phone']
+        email_address = account['_email']
+        email_password = account['_password']
+        
+        print(f"Processing account with phone: {phone_number}, email: {email_address}")
+        
+        # Login to Ozon
+        cookies = login_to_ozon(browser, phone_number, email_address, email_password, index)
+        return index, cookies
+        
+    except Exception as e:
+        print(f"Error processing account {index+1}: {e}")
+        # Start from a fresh browser for the next account
+        quit_worker_browser()
+        return index, None
+
+def save_cookies(target_file, cookies_by_index):
+    """Write cookies into the Cookies column of the workbook, leaving other columns untouched"""
+    workbook = openpyxl.load_workbook(target_file)
+    sheet = workbook.worksheets[0]
+    
+    headers = [cell.value for cell in sheet[1]]
+    if 'Cookies' in headers:
+        column = headers.index('Cookies') + 1
+    else:
+        column = sheet.max_column + 1
+        sheet.cell(row=1, column=column, value='Cookies')
+    
+    # DataFrame row 0 is the first row under the header
+    for index, cookies in cookies_by_index.items():
+        sheet.cell(row=index + 2, column=column, value=cookies)
+    
+    workbook.save(target_file)
 
 def main():
     # Proxy settings
@@ -428,6 +901,14 @@ def main():
     proxy_username = "uCpNVmKQ"
     proxy_password = "TMpbnhn7"
     
+    # Number of accounts processed concurrently, each in its own browser process
+    max_workers = 4
+    
+    # Cookies are appended to the checkpoint as they arrive; the workbook is only
+    # rewritten every checkpoint_every results and once at the end
+    checkpoint_file = "cookies_checkpoint.jsonl"
+    checkpoint_every = 10
+    
     # Load Excel file
     try:
         # Try to load the original file
@@ -437,95 +918,135 @@ def main():
         # Check if updated file exists and use it if it does
         if os.path.exists(target_file):
             print(f"Using existing updated file: {target_file}")
-            df = pd.read_excel(target_file)
         else:
             print(f"Loading original file: {source_file}")
-            df = pd.read_excel(source_file)
             # Create a copy for the updated data
-            df.to_excel(target_file, index=False)
+            shutil.copyfile(source_file, target_file)
+        
+        # Only load the columns that are used; the rest stay in the workbook untouched
+        df = pd.read_excel(target_file, usecols=lambda column: column in _ACCOUNT_COLUMNS, dtype=str)
         
         print(f"Successfully loaded Excel file with {len(df)} rows")
         
-        # Add a Cookies column if it doesn't exist
+        # Add a Cookies column if it doesn't exist; save_cookies adds it to the file
         if 'Cookies' not in df.columns:
             df['Cookies'] = None
-            df.to_excel(target_file, index=False)
+        
+        # Clean account details for the whole sheet at once. Numbers without '+'
+        # that start with 8 or 9 become +7 followed by their last 10 digits
+        phones = df['Телефон'].astype(str).str.strip()
+        needs_country_code = ~phones.str.startswith('+') & phones.str[:1].isin(['8', '9'])
+        df['_phone'] = phones.where(~needs_country_code, '+7' + phones.str[-10:])
+        df['_email'] = df['Привязанная\nпочта'].astype(str).str.strip()
+        df['_password'] = df['пароль от\nпочты'].astype(str).str.strip()
             
     except Exception as e:
         print(f"Failed to load Excel file: {e}")
         return
     
-    browser = None
-    plugin_path = None
+    # Check the proxy once over plain HTTP before any browser is started. If no
+    # service answers through it there is no point launching Chrome at all; an IP
+    # outside the expected range is still re-checked by each browser
+    proxy_ip = check_proxy_ip(proxy_host, proxy_port, proxy_username, proxy_password)
+    if proxy_ip is None:
+        print("Proxy check failed - no IP service answered through the proxy. Aborting.")
+        return
+    proxy_verified = "85.142" in proxy_ip
+    if proxy_verified:
+        print(f"Proxy confirmed working - current IP: {proxy_ip}")
+    else:
+        print(f"Warning: IP {proxy_ip} doesn't match expected proxy range, each browser will verify it")
     
-    # Process each account
-    for index, row in df.iterrows():
-        # Skip accounts that already have cookies
-        if pd.notna(row.get('Cookies')) and row.get('Cookies'):
-            print(f"Account {index+1}/{len(df)} already has cookies. Skipping.")
-            continue
-            
-        print(f"\n{'='*50}")
-        print(f"Processing account {index+1}/{len(df)}")
-        print(f"{'='*50}")
-        
-        # Create a new browser instance for each account
-        if browser:
-            try:
-                browser.quit()
-            except:
-                pass
-                
-        if plugin_path and os.path.exists(plugin_path):
-            try:
-                os.remove(plugin_path)
-            except:
-                pass
-        
-        # Setup new browser with proxy
-        browser, plugin_path = setup_browser_with_proxy(proxy_host, proxy_port, proxy_username, proxy_password)
-        
-        if not browser:
-            print("Failed to initialize browser. Skipping this account.")
-            continue
+    # The proxy extension is identical for every account, so build it once
+    try:
+        plugin_path = create_proxy_auth_extension(
+            proxy_host=proxy_host,
+            proxy_port=proxy_port,
+            proxy_username=proxy_username,
+            proxy_password=proxy_password
+        )
+    except Exception as e:
+        print(f"Failed to create proxy extension: {e}")
+        return
+    
+    # Cookies obtained in this run, keyed by row index, waiting to be written to the workbook
+    saved_cookies = {}
+    
+    # Recover cookies saved by a previous run that stopped before its final write
+    if os.path.exists(checkpoint_file):
+        damaged = False
+        with open(checkpoint_file, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    index, cookies = record['index'], record['cookies']
+                except (ValueError, KeyError, TypeError) as e:
+                    # Typically a partial last line from a run killed mid-write
+                    print(f"Skipping unreadable line in {checkpoint_file}: {e}")
+                    damaged = True
+                    continue
+                df.at[index, 'Cookies'] = cookies
+                saved_cookies[index] = cookies
         
-        # Verify proxy is working
-        if not verify_proxy_working(browser):
-            print("Proxy verification failed. Skipping this account.")
-            browser.quit()
-            continue
+        # Rewrite without the bad lines so new records are not appended onto a partial one
+        if damaged:
+            with open(checkpoint_file, 'w', encoding='utf-8') as f:
+                for index, cookies in saved_cookies.items():
+                    f.write(json.dumps({'index': int(index), 'cookies': cookies}, ensure_ascii=False) + '\n')
+        print(f"Restored cookies from {checkpoint_file}")
+    
+    # Collect accounts that still need cookies in one vectorized pass
+    todo = df.index[df['Cookies'].isna() | (df['Cookies'] == '')].tolist()
+    records = df.loc[todo, ['_phone', '_email', '_password']].to_dict('records')
+    pending = list(zip(todo, records))
+    print(f"{len(df) - len(todo)}/{len(df)} accounts already have cookies. Skipping them.")
+    
+    # Workers only return cookies; the spreadsheet is updated here, in the main
+    # process, so writes are naturally serialized as results arrive
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        futures = [
+            executor.submit(process_account, index, account, plugin_path, proxy_verified)
+            for index, account in pending
+        ]
         
-        # Get account details
-        try:
-            phone_number = str(row['Телефон']).strip()
-            email_address = str(row['Привязанная\nпочта']).strip()
-            email_password = str(row['пароль от\nпочты']).strip()
-            
-            print(f"Processing account with phone: {phone_number}, email: {email_address}")
-            
-            # Login to Ozon
-            login_success = login_to_ozon(browser, phone_number, email_address, email_password, index, df)
+        for completed, future in enumerate(as_completed(futures), start=1):
+            try:
+                index, cookies = future.result()
+            except Exception as e:
+                print(f"Worker failed: {e}")
+                continue
             
-            if login_success:
+            if cookies:
+                df.at[index, 'Cookies'] = str(cookies)
+                saved_cookies[index] = str(cookies)
+                
+                # Durable O(1) save per account
+                with open(checkpoint_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'index': int(index), 'cookies': str(cookies)}, ensure_ascii=False) + '\n')
+                print(f"Saved cookies for account {index+1}")
                 print(f"Account {index+1} processed successfully")
             else:
                 print(f"Failed to process account {index+1}")
-                
-            # Clear cookies for next account
-            browser.delete_all_cookies()
             
-        except Exception as e:
-            print(f"Error processing account details: {e}")
-            continue
+            if completed % checkpoint_every == 0:
+                # A failed flush must not stop the loop; the checkpoint still has the cookies
+                try:
+                    save_cookies(target_file, saved_cookies)
+                except Exception as e:
+                    print(f"Failed to save {target_file}, cookies kept in {checkpoint_file}: {e}")
     
-    # Final cleanup
-    if browser:
-        try:
-            browser.quit()
-        except:
-            pass
+    # Merge everything into the workbook; the checkpoint is no longer needed afterwards
+    try:
+        save_cookies(target_file, saved_cookies)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+    except Exception as e:
+        print(f"Failed to save {target_file}, cookies kept in {checkpoint_file}: {e}")
     
-    if plugin_path and os.path.exists(plugin_path):
+    # Final cleanup
+    if os.path.exists(plugin_path):
         try:
             os.remove(plugin_path)
         except: